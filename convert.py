@@ -65,6 +65,7 @@ Convert Naver CLOVA AI OCR format data to training-datasets-splitter format data
 
 """
 
+import io
 import os
 import sys
 import time
@@ -72,10 +73,19 @@ import json
 import uuid
 import shutil
 import argparse
+import functools
+import mimetypes
+import threading
 import requests
 
 from PIL import Image
-from collections import OrderedDict
+from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+# shared across all workers so the TCP/TLS connections to CLOVA OCR are reused
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
 
 
 def run(args):
@@ -84,81 +94,142 @@ def run(args):
     if not os.path.exists(args.input_path):
         sys.exit(f"Can't find '{os.path.abspath(args.input_path)}' directory.")
 
-    if os.path.isdir(args.output_path):
+    if os.path.isdir(args.output_path) and not args.resume:
         sys.exit(f"'{os.path.abspath(args.output_path)}' directory is already exists.")
         # print(f"'{os.path.abspath(args.output_path)}' directory is already exists.")
     else:
         # dirs[0]: root, dirs[1]: CLOVA OCR result, dirs[2]: cropped, dirs[3]: converted (for LabelMe)
-        dirs = create_working_directory(args.output_path, ["recognized", "cropped", "converted"])
+        dirs = create_working_directory(args.output_path, ["recognized", "cropped", "converted"],
+                                        exist_ok=args.resume)
 
     files, count = get_files(args.input_path)
 
-    labels = open(os.path.join(args.output_path, dirs[2], "labels.txt"), "w", encoding="utf8")
+    labels_file = os.path.join(dirs[2], "labels.txt")
 
     start_time = time.time()
-    digits = len(str(count))
-    for ii, file_name in enumerate(files):
-        if (ii + 1) % 10 == 0:
-            print(("\r%{}d / %{}d Processing !!".format(digits, digits)) % (ii + 1, count), end="")
-
-        name, ext = file_name.split('.')
-
-        clova_json_file = request_recognition_from_clova_ocr(args, dirs[1], file_name)
-        # clova_json_file = f"{dirs[1]}/{name}_clova.json"
-        print(f"clova_json: {clova_json_file}")
-
-        with open(os.path.join(clova_json_file)) as f:
-            json_data = json.load(f)
-
-        json_dict = OrderedDict()
-
-        json_dict["version"] = "4.5.9"
-        json_dict["shape_type"] = "rectangle"
-        json_dict["flags"] = {}
-        shapes = []
-
-        with Image.open(os.path.join(args.input_path, file_name)) as img:
-            for jj, fields in enumerate(json_data["images"][0]["fields"]):
-                label = fields["inferText"]
-                bbox = get_bbox(fields["boundingPoly"]["vertices"])
-                # print(f"label: {label}, bbox: {bbox}")
-                if not valid_crop_size(bbox, args.min_image_size):
-                    # print(f"'{file_name}' - invalid bbox: {bbox}")
+    limiter = RequestLimiter(args.max_concurrency, args.rps)
+    with open(labels_file, "w", encoding="utf8", buffering=1024 * 1024) as labels, \
+            ThreadPoolExecutor(max_workers=4) as copy_executor, \
+            ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(process_one, file_name, args, dirs, limiter, copy_executor)
+                   for file_name in files]
+        failed = []
+        try:
+            # collect in submission order so labels.txt stays sorted and identical between runs
+            for file_name, future in tqdm(zip(files, futures), total=count, desc="convert"):
+                try:
+                    crops = future.result()
+                except Exception as e:
+                    tqdm.write(f"'{file_name}' - failed: {e}")
+                    failed.append(file_name)
                     continue
 
-                # save cropped image and label
-                cropped_image = img.crop(bbox)
-                cropped_file = f"{name}_{jj:03d}.{ext}"
-                cropped_image.save(os.path.join(args.output_path, dirs[2], cropped_file))
-                labels.write(f"{cropped_file}\t{label}\n")
-
-                shapes_dict = OrderedDict()
-                shapes_dict["label"] = label
-                shapes_dict["points"] = [[bbox[0], bbox[1]], [bbox[2], bbox[3]]]
-                shapes_dict["group_id"] = None
-                shapes_dict["shape_type"] = "rectangle"
-                shapes_dict["flags"] = {}
-                shapes.append(shapes_dict)
-
-            json_dict["shapes"] = shapes
-            json_dict["imagePath"] = file_name
-            json_dict["imageData"] = None
-            json_dict["imageHeight"] = img.size[1]
-            json_dict["imageWidth"] = img.size[0]
-
-        # save json (labelme format)
-        shutil.copy(os.path.join(args.input_path, file_name), os.path.join(dirs[3], file_name))
-        with open(os.path.join(dirs[3], name + ".json"), 'w', encoding='utf-8') as outfile:
-            json.dump(json_dict, outfile, ensure_ascii=False, indent="\t")
-
-    labels.close()
+                # labels.txt is written only from the main thread, one batch per image
+                labels.writelines(f"{cropped_file}\t{label}\n" for cropped_file, label in crops)
+        except KeyboardInterrupt:
+            # don't let the executor drain the remaining queue on Ctrl-C
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
     elapsed_time = (time.time() - start_time) / 60.
-    print("\n- processing time: %.1fmin" % elapsed_time)
+    print("- processing time: %.1fmin" % elapsed_time)
+    if failed:
+        print(f"- failed: {len(failed)} / {count} files (rerun with --resume to retry them)")
+
+
+def process_one(file_name, args, dirs, limiter, copy_executor):
+    """ Recognize, crop and convert a single image, returning its (cropped_file, label) pairs """
+
+    name, ext = os.path.splitext(file_name)
+    ext = ext[1:]
+    crop_ext = ext if args.crop_format == "same" else args.crop_format
+
+    # dirs already hold the full output paths, so they are not joined onto output_path again
+    in_file = os.path.join(args.input_path, file_name)
+
+    # a full copy runs off this thread while the OCR request is in flight; a link is placed inline below
+    copy_future = None
+    if args.copy_mode == "copy":
+        copy_future = copy_executor.submit(place_file, in_file, os.path.join(dirs[3], file_name),
+                                           args.copy_mode)
+
+    clova_json_file, json_data = request_recognition_from_clova_ocr(args, dirs[1], file_name, name, ext,
+                                                                    limiter)
+    # clova_json_file = f"{dirs[1]}/{name}_clova.json"
+    # print(f"clova_json: {clova_json_file}")
+
+    json_dict = {
+        "version": "4.5.9",
+        "shape_type": "rectangle",
+        "flags": {}
+    }
+    crops = []
+
+    # each bbox is computed once and shared by the LabelMe shapes and the crops below
+    valid_fields = [
+        (jj, fields["inferText"], bbox)
+        for jj, fields in enumerate(json_data["images"][0]["fields"])
+        for bbox in (get_bbox(fields["boundingPoly"]["vertices"]),)
+        if valid_crop_size(bbox, args.min_image_size)
+    ]
+    shapes = [
+        {
+            "label": label,
+            "points": [[bbox[0], bbox[1]], [bbox[2], bbox[3]]],
+            "group_id": None,
+            "shape_type": "rectangle",
+            "flags": {}
+        }
+        for _, label, bbox in valid_fields
+    ]
+
+    # img.size is read from the header; the pixel data is only decoded when there is something to crop
+    with Image.open(in_file) as img:
+        for jj, label, bbox in valid_fields:
+            # save cropped image and label
+            cropped_image = img.crop(bbox)
+            cropped_file = f"{name}_{jj:03d}.{crop_ext}"
+            save_cropped_image(cropped_image, os.path.join(dirs[2], cropped_file), args)
+            crops.append((cropped_file, label))
+
+        json_dict["shapes"] = shapes
+        json_dict["imagePath"] = file_name
+        json_dict["imageData"] = None
+        json_dict["imageHeight"] = img.size[1]
+        json_dict["imageWidth"] = img.size[0]
+
+    # save json (labelme format)
+    if copy_future is None:
+        place_file(in_file, os.path.join(dirs[3], file_name), args.copy_mode)
+    else:
+        copy_future.result()
+    with open(os.path.join(dirs[3], name + ".json"), 'w', encoding='utf-8') as outfile:
+        outfile.write(json.dumps(json_dict, ensure_ascii=False, indent="\t"))
+
+    return crops
+
+
+def save_cropped_image(image, path, args):
+    ext = os.path.splitext(path)[1][1:].lower()
+    if ext == "png":
+        # zlib level 1 is several times faster than the default (6) and barely larger for text crops
+        image.save(path, compress_level=args.png_compress_level)
+    elif args.crop_format == "jpg":
+        # converted from another format; JPEG cannot store alpha or palette images
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(path, quality=92, subsampling=0)
+    else:
+        image.save(path)
 
 
-def request_recognition_from_clova_ocr(args, subdir, image_file):
-    name, ext = image_file.split('.')
+def request_recognition_from_clova_ocr(args, subdir, image_file, name, ext, limiter):
+    # reuse the result of a previous run instead of calling CLOVA OCR again
+    json_file = os.path.join(subdir, name + "_clova.json")
+    if os.path.exists(json_file) and os.path.getsize(json_file) > 0:
+        with open(json_file, encoding='utf-8') as f:
+            return json_file, json.load(f)
+
     request_json = {
         'images': [
             {
@@ -172,31 +243,152 @@ def request_recognition_from_clova_ocr(args, subdir, image_file):
     }
 
     payload = {'message': json.dumps(request_json).encode('UTF-8')}
-    files = [
-        ('file', open(os.path.join(args.input_path, image_file), 'rb'))
-    ]
     headers = {
         'X-OCR-SECRET': args.clova_secret_key
     }
 
-    response = requests.request("POST", args.clova_api_url, headers=headers, data=payload, files=files)
-
-    res = json.loads(response.text.encode('utf8'))
+    res = post_clova_ocr(args, image_file, payload, headers, limiter)
     # print(res)
 
-    json_file = os.path.join(args.output_path, subdir, name + "_clova.json")
     # print(f"json_file: {json_file}")
-    with open(json_file, 'w', encoding='utf-8') as outfile:
-        json.dump(res, outfile, indent=4, ensure_ascii=False)
+    # write to a temporary file first so an interrupted run never leaves a partial cache entry
+    with open(json_file + ".tmp", 'w', encoding='utf-8') as outfile:
+        json.dump(res, outfile, ensure_ascii=False, separators=(',', ':'))
+    os.replace(json_file + ".tmp", json_file)
+
+    return json_file, res
+
+
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TransientOCRError(Exception):
+    """ CLOVA OCR failure that is worth retrying (throttling, quota, server-side or network error) """
+
+
+def retry_on_transient_error(attempts=3, min_delay=1., max_delay=16.):
+    """ Retry the decorated call on TransientOCRError with exponential backoff """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            delay = min_delay
+            for attempt in range(1, attempts + 1):
+                try:
+                    return func(*args, **kwargs)
+                except TransientOCRError as e:
+                    if attempt == attempts:
+                        raise
+                    tqdm.write(f"{e} - retry {attempt}/{attempts - 1} in {delay:.0f}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+
+        return wrapper
+
+    return decorator
+
+
+@retry_on_transient_error(attempts=3, min_delay=1., max_delay=16.)
+def post_clova_ocr(args, image_file, payload, headers, limiter):
+    mime_type = mimetypes.guess_type(image_file)[0] or 'application/octet-stream'
+    scale = (1., 1.)
+
+    with open(os.path.join(args.input_path, image_file), 'rb') as fh:
+        upload = fh
+        if args.max_upload_dim:
+            upload, scale = downsize_for_upload(fh, args.max_upload_dim)
+
+        files = [
+            ('file', (image_file, upload, mime_type))
+        ]
+
+        with limiter:
+            try:
+                response = SESSION.post(args.clova_api_url, headers=headers, data=payload, files=files,
+                                        timeout=(5, 60))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise TransientOCRError(f"'{image_file}' - {type(e).__name__}: {e}") from e
 
-    return json_file
+    if response.status_code in TRANSIENT_STATUS_CODES:
+        raise TransientOCRError(f"'{image_file}' - HTTP {response.status_code}")
+    if not response.ok and any(word in response.text.lower() for word in ("quota", "rate limit")):
+        raise TransientOCRError(f"'{image_file}' - HTTP {response.status_code}: {response.text}")
+    response.raise_for_status()
+
+    res = json.loads(response.content)
+    if scale != (1., 1.):
+        rescale_vertices(res, scale)
+
+    return res
+
+
+def downsize_for_upload(fh, max_dim):
+    """ Shrink the image to fit in max_dim x max_dim, returning the upload stream and the (x, y) scale """
+
+    with Image.open(fh) as img:
+        width, height = img.size
+        if max(width, height) <= max_dim:
+            fh.seek(0)
+            return fh, (1., 1.)
+
+        image_format = img.format
+        img.thumbnail((max_dim, max_dim))
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format)
+        buffer.seek(0)
+
+        return buffer, (width / img.size[0], height / img.size[1])
+
+
+def rescale_vertices(res, scale):
+    """ Map the vertices recognized on a downsized upload back to the original image """
+
+    for image in res.get("images", []):
+        for fields in image.get("fields", []):
+            for vertex in fields["boundingPoly"]["vertices"]:
+                vertex["x"] = vertex["x"] * scale[0]
+                vertex["y"] = vertex["y"] * scale[1]
+
+
+class RequestLimiter:
+    """ Cap the number of in-flight CLOVA OCR requests and keep a minimum interval between them """
+
+    def __init__(self, max_concurrency, rps=0):
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._interval = 1. / rps if rps > 0 else 0.
+        self._next_slot = 0.
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0., self._next_slot - now)
+            self._next_slot = max(now, self._next_slot) + self._interval
+        time.sleep(wait)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._semaphore.release()
 
 
 def get_bbox(points):
-    left = min(p["x"] for p in points)  # left = points[0]["x"]
-    upper = min(p["y"] for p in points)  # upper = points[0]["y"]
-    right = max(p["x"] for p in points)  # right = points[2]["x"]
-    lower = max(p["y"] for p in points)  # lower = points[2]["y"]
+    # single pass over the vertices (CLOVA OCR may return rotated quadrilaterals)
+    it = iter(points)
+    p = next(it)
+    left = right = p["x"]
+    upper = lower = p["y"]
+    for p in it:
+        x, y = p["x"], p["y"]
+        if x < left:
+            left = x
+        elif x > right:
+            right = x
+        if y < upper:
+            upper = y
+        elif y > lower:
+            lower = y
 
     bbox = [left, upper, right, lower]
     # print(f"bbox: {bbox}")
@@ -213,30 +405,80 @@ def valid_crop_size(bbox, size):
 
 def get_files(path, except_file=""):
     file_list = []
+    except_name = os.path.basename(except_file)
 
-    for file in os.listdir(path):
-        if file.startswith(".") or file == os.path.basename(except_file):
-            print('except file name: ', file)
-            continue
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith(".") or entry.name == except_name:
+                print('except file name: ', entry.name)
+                continue
 
-        file_list.append(file)
+            if entry.is_file():
+                file_list.append(entry.name)
 
     file_list.sort()
 
     return file_list, len(file_list)
 
 
-def create_working_directory(root, sub_dirs=None):
+def place_file(src, dst, mode="link"):
+    """ Place src at dst as a hard link or symbolic link, falling back to a real copy """
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if mode == "link":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    if mode in ("link", "symlink"):
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copy(src, dst)
+
+
+def create_working_directory(root, sub_dirs=None, exist_ok=False):
     dirs = [root]
-    os.makedirs(root)
+    os.makedirs(root, exist_ok=exist_ok)
     for sub in sub_dirs:
         path = os.path.join(root, sub)
         dirs.append(path)
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=exist_ok)
 
     return dirs
 
 
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {value}")
+
+    return number
+
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {value}")
+
+    return number
+
+
+def non_negative_float(value):
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {value}")
+
+    return number
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Convert dataset for training-datasets-splitter')
 
@@ -246,6 +488,22 @@ def parse_arguments():
     # parser.add_argument('--clova_api_url', type=str, required=True, help='Your CLOVA OCR API URL')
     # parser.add_argument('--clova_secret_key', type=str, required=True, help='Your CLOVA OCR secret key')
     parser.add_argument('--min_image_size', type=int, default=16, help='The minimum size of the cropped image')
+    parser.add_argument('--workers', type=positive_int, default=16,
+                        help='The number of images to be processed concurrently')
+    parser.add_argument('--crop_format', type=str, default='same', choices=['same', 'png', 'jpg'],
+                        help='The file format of the cropped images (same: keep the input format)')
+    parser.add_argument('--png_compress_level', type=int, default=1, choices=range(10),
+                        help='The zlib compression level (0-9) of cropped PNG images')
+    parser.add_argument('--max_concurrency', type=positive_int, default=8,
+                        help='The maximum number of in-flight CLOVA OCR requests')
+    parser.add_argument('--rps', type=non_negative_float, default=0,
+                        help='The maximum number of CLOVA OCR requests per second (0: unlimited)')
+    parser.add_argument('--copy_mode', type=str, default='link', choices=['link', 'symlink', 'copy'],
+                        help='How to place the input images next to the LabelMe json files')
+    parser.add_argument('--max_upload_dim', type=non_negative_int, default=0,
+                        help='Downsize images larger than this before uploading to CLOVA OCR (0: no resize)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue into an existing output directory, reusing the recognized results')
 
     parsed_args = parser.parse_args()
     return parsed_args